@@ -3,8 +3,10 @@ import logging
 import numpy
 import tensorflow as tf
 from scipy import sparse
+from tensorflow.contrib.compiler import jit
+from tensorflow.core.protobuf import rewriter_config_pb2
 
-from .util import balancer, extractor, shuffle_data
+from .util import balancer, extractor, sample_without_replacement, shuffle_data
 
 log = logging.getLogger(__file__)
 
@@ -24,6 +26,9 @@ class VAEArith:
                     learning rate of optimization algorithm
                 key: `model_path`: basestring
                     path to save the model after training
+                key: `mixed_precision`: bool
+                    if `True`: trains the network with float16 activations and dynamic loss scaling
+                    on GPUs with tensor cores. Defaults to `False`.
             x_dimension: integer
                 number of gene expression space dimensions.
             z_dimension: integer
@@ -37,18 +42,25 @@ class VAEArith:
         self.learning_rate = kwargs.get("learning_rate", 0.001)
         self.dropout_rate = kwargs.get("dropout_rate", 0.2)
         self.model_to_use = kwargs.get("model_path", "../models/scgen")
-        self.is_training = tf.placeholder(tf.bool, name='training_flag')
-        self.global_step = tf.Variable(0, name='global_step', trainable=False, dtype=tf.int32)
+        self.mixed_precision = kwargs.get("mixed_precision", False)
+        self.is_training = tf.placeholder_with_default(False, shape=(), name='training_flag')
         self.x = tf.placeholder(tf.float32, shape=[None, self.x_dim], name="data")
-        self.z = tf.placeholder(tf.float32, shape=[None, self.z_dim], name="latent")
-        self.time_step = tf.placeholder(tf.int32)
-        self.size = tf.placeholder(tf.int32)
         self.init_w = tf.contrib.layers.xavier_initializer()
         self._create_network()
         self._loss_function()
-        self.sess = tf.Session()
+        self._create_inference_network()
+        # XLA JIT clustering fuses the memory-bound Dense/BN/LeakyReLU/Dropout chains and the loss
+        # reductions into single kernels. On CPU-only machines `TF_XLA_FLAGS=--tf_xla_cpu_global_jit`
+        # has to be set in addition to enable it.
+        config = tf.ConfigProto()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        if self.mixed_precision:
+            # Enabled per session, `enable_mixed_precision_graph_rewrite` would enable it process-wide.
+            config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+        self.sess = tf.Session(config=config)
         self.saver = tf.train.Saver(max_to_keep=1)
         self.init = tf.global_variables_initializer().run(session=self.sess)
+        self._fold_bn_for_inference()
 
     def _encoder(self):
         """
@@ -62,8 +74,9 @@ class VAEArith:
             # Returns
                 mean: Tensor
                     A dense layer consists of means of gaussian distributions of latent space dimensions.
-                log_var: Tensor
-                    A dense layer consists of log transformed variances of gaussian distributions of latent space dimensions.
+                sigma: Tensor
+                    A dense layer with softplus activation consists of standard deviations of gaussian distributions
+                    of latent space dimensions.
         """
         with tf.variable_scope("encoder", reuse=tf.AUTO_REUSE):
             h = tf.layers.dense(inputs=self.x, units=800, kernel_initializer=self.init_w, use_bias=False)
@@ -75,8 +88,9 @@ class VAEArith:
             h = tf.nn.leaky_relu(h)
             h = tf.layers.dropout(h, self.dropout_rate, training=self.is_training)
             mean = tf.layers.dense(inputs=h, units=self.z_dim, kernel_initializer=self.init_w)
-            log_var = tf.layers.dense(inputs=h, units=self.z_dim, kernel_initializer=self.init_w)
-            return mean, log_var
+            raw_sigma = tf.layers.dense(inputs=h, units=self.z_dim, kernel_initializer=self.init_w)
+            sigma = tf.nn.softplus(raw_sigma) + 1e-6
+            return mean, sigma
 
     def _decoder(self):
         """
@@ -109,7 +123,7 @@ class VAEArith:
         """
             Samples from standard Normal distribution with shape [size, z_dim] and
             applies re-parametrization trick. It is actually sampling from latent
-            space distributions with N(mu, var) computed in `_encoder` function.
+            space distributions with N(mu, sigma^2) computed in `_encoder` function.
 
             # Parameters
                 No parameters are needed.
@@ -117,13 +131,14 @@ class VAEArith:
             # Returns
                 The computed Tensor of samples with shape [size, z_dim].
         """
-        eps = tf.random_normal(shape=[self.size, self.z_dim])
-        return self.mu + tf.exp(self.log_var / 2) * eps
+        with jit.experimental_jit_scope(), tf.name_scope("sample_z"):
+            eps = tf.random_normal(shape=tf.shape(self.mu))
+            return tf.add(self.mu, self.sigma * eps, name="z")
 
     def _create_network(self):
         """
             Constructs the whole VAE network. It is step-by-step constructing the VAE
-            network. First, It will construct the encoder part and get mu, log_var of
+            network. First, It will construct the encoder part and get mu, sigma of
             latent space. Second, It will sample from the latent space to feed the
             decoder part in next step. Finally, It will reconstruct the data by
             constructing decoder part of VAE.
@@ -134,10 +149,114 @@ class VAEArith:
             # Returns
                 Nothing will be returned.
         """
-        self.mu, self.log_var = self._encoder()
+        self.mu, self.sigma = self._encoder()
         self.z_mean = self._sample_z()
         self.x_hat = self._decoder()
 
+    def _folded_weights(self, scope, dense_name, bn_name=None, use_bias=True, epsilon=1e-3):
+        """
+            Creates the kernel and bias of the trained dense layer `dense_name` of `scope`
+            with the batch normalization layer `bn_name` folded into them, i.e.
+            `W' = W * gamma / sigma` and `b' = beta - mu * gamma / sigma`. The folded
+            weights are kept in local variables which are refreshed by `_fold_bn_for_inference`.
+
+            # Parameters
+                scope: basestring
+                    Variable scope of the trained sub-network (`encoder` or `decoder`).
+                dense_name: basestring
+                    Name of the trained dense layer inside `scope`.
+                bn_name: basestring
+                    Name of the batch normalization layer following `dense_name`. if `None`
+                    the dense layer is used as it is.
+                use_bias: bool
+                    Whether the dense layer `dense_name` has a bias. Only used if `bn_name` is `None`,
+                    a missing bias is replaced by zeros.
+                epsilon: float
+                    epsilon of the batch normalization layer (default of `tf.layers.batch_normalization`).
+
+            # Returns
+                kernel: Variable
+                    The folded kernel in shape [n_inputs, n_units].
+                bias: Variable
+                    The folded bias in shape [n_units, ].
+        """
+        with tf.variable_scope(scope, reuse=True):
+            kernel = tf.get_variable(f"{dense_name}/kernel")
+            if bn_name is None and use_bias:
+                bias = tf.get_variable(f"{dense_name}/bias")
+            elif bn_name is None:
+                bias = tf.zeros([kernel.shape[1]])
+            else:
+                gamma = tf.get_variable(f"{bn_name}/gamma")
+                beta = tf.get_variable(f"{bn_name}/beta")
+                moving_mean = tf.get_variable(f"{bn_name}/moving_mean")
+                moving_variance = tf.get_variable(f"{bn_name}/moving_variance")
+                scale = gamma * tf.rsqrt(moving_variance + epsilon)
+                kernel = kernel * scale
+                bias = beta - moving_mean * scale
+        with tf.name_scope(f"inference/{scope}/{dense_name}"):
+            kernel = tf.Variable(kernel, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="kernel")
+            bias = tf.Variable(bias, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="bias")
+        self._folded_variables += [kernel, bias]
+        return kernel, bias
+
+    def _create_inference_network(self):
+        """
+            Constructs the inference copy of the VAE network used by `to_latent` and
+            `reconstruct`. It shares the trained weights of `_encoder` and `_decoder`,
+            but every batch normalization is folded into its preceding dense layer and
+            dropout is removed, so that no batch normalization op runs at inference time.
+            Only the mean of the latent distributions is computed, `sigma` and the
+            sampling step are left out. The forward pass is compiled with XLA; compiled
+            kernels are cached by the session and reused by later calls with the same batch size.
+            The decoder input is the latent mean shifted by `latent_shift` (zero by default),
+            so `predict` can encode, shift and decode in a single run.
+
+            # Parameters
+                No parameters are needed.
+
+            # Returns
+                Nothing will be returned.
+        """
+        self._folded_variables = []
+        encoder_weights = [self._folded_weights("encoder", "dense", "batch_normalization"),
+                           self._folded_weights("encoder", "dense_1", "batch_normalization_1"),
+                           self._folded_weights("encoder", "dense_2")]
+        # The output of the second batch normalization is not used in `_decoder`.
+        decoder_weights = [self._folded_weights("decoder", "dense", "batch_normalization"),
+                           self._folded_weights("decoder", "dense_1", use_bias=False),
+                           self._folded_weights("decoder", "dense_2")]
+        self._fold_op = tf.variables_initializer(self._folded_variables)
+        self.latent_shift = tf.placeholder_with_default(tf.zeros([self.z_dim]), shape=[self.z_dim],
+                                                        name="latent_shift")
+        with jit.experimental_jit_scope():
+            h = self.x
+            for kernel, bias in encoder_weights[:-1]:
+                h = tf.nn.leaky_relu(tf.matmul(h, kernel) + bias)
+            kernel, bias = encoder_weights[-1]
+            self.mu_inference = tf.matmul(h, kernel) + bias
+            self.mu_inference_avg = tf.reduce_mean(self.mu_inference, axis=0)
+            self.z_inference = tf.placeholder_with_default(self.mu_inference + self.latent_shift,
+                                                           shape=[None, self.z_dim], name="latent")
+            h = self.z_inference
+            for kernel, bias in decoder_weights[:-1]:
+                h = tf.nn.leaky_relu(tf.matmul(h, kernel) + bias)
+            kernel, bias = decoder_weights[-1]
+            self.x_hat_inference = tf.nn.relu(tf.matmul(h, kernel) + bias, name="reconstruction")
+
+    def _fold_bn_for_inference(self):
+        """
+            Recomputes the folded weights of the inference network from the current
+            network weights. Has to be called whenever the weights change.
+
+            # Parameters
+                No parameters are needed.
+
+            # Returns
+                Nothing will be returned.
+        """
+        self.sess.run(self._fold_op)
+
     def _loss_function(self):
         """
             Defines the loss function of VAE network after constructing the whole
@@ -151,18 +270,22 @@ class VAEArith:
             # Returns
                 Nothing will be returned.
         """
-        kl_loss = 0.5 * tf.reduce_sum(
-            tf.exp(self.log_var) + tf.square(self.mu) - 1. - self.log_var, 1)
-        recon_loss = 0.5 * tf.reduce_sum(tf.square((self.x - self.x_hat)), 1)
-        self.vae_loss = tf.reduce_mean(recon_loss + 0.001 * kl_loss)
+        with jit.experimental_jit_scope():
+            kl_loss = 0.5 * tf.reduce_sum(
+                tf.square(self.sigma) + tf.square(self.mu) - 1. - 2. * tf.log(self.sigma), 1)
+            recon_loss = 0.5 * tf.reduce_sum(tf.square((self.x - self.x_hat)), 1)
+            self.vae_loss = tf.reduce_mean(recon_loss + 0.001 * kl_loss)
         with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-            self.solver = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.vae_loss)
+            optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+            if self.mixed_precision:
+                optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, "dynamic")
+            self.solver = optimizer.minimize(self.vae_loss)
 
     def to_latent(self, data):
         """
             Map `data` in to the latent space. This function will feed data
             in encoder part of VAE and compute the latent space coordinates
-            for each sample in data.
+            (the means of the latent distributions) for each sample in data.
 
             # Parameters
                 data:  numpy nd-array
@@ -172,13 +295,14 @@ class VAEArith:
                 latent: numpy nd-array
                     Returns array containing latent space encoding of 'data'
         """
-        latent = self.sess.run(self.z_mean, feed_dict={self.x: data, self.size: data.shape[0], self.is_training: False})
+        latent = self.sess.run(self.mu_inference, feed_dict={self.x: data})
         return latent
 
     def _avg_vector(self, data):
         """
             Computes the average of points which computed from mapping `data`
-            to encoder part of VAE.
+            to encoder part of VAE. The average of the latent means is computed
+            inside the graph so only a single `z_dim` vector is fetched.
 
             # Parameters
                 data:  numpy nd-array
@@ -188,10 +312,28 @@ class VAEArith:
                 The average of latent space mapping in numpy nd-array.
 
         """
-        latent = self.to_latent(data)
-        latent_avg = numpy.average(latent, axis=0)
+        latent_avg = self.sess.run(self.mu_inference_avg, feed_dict={self.x: data})
         return latent_avg
 
+    def _sample_dense(self, data, indices):
+        """
+            Selects rows `indices` of `data` and densifies only the selected rows
+            if `data` is sparse.
+
+            # Parameters
+                data: numpy nd-array or scipy sparse matrix
+                    Matrix in shape [n_obs, n_vars].
+                indices: numpy nd-array
+                    Indices of rows to be selected.
+
+            # Returns
+                Dense numpy nd-array of the selected rows in shape [len(indices), n_vars].
+        """
+        data = data[indices, :]
+        if sparse.issparse(data):
+            data = data.toarray()
+        return data
+
     def reconstruct(self, data, use_data=False):
         """
             Map back the latent space encoding via the decoder.
@@ -209,10 +351,9 @@ class VAEArith:
                     Returns 'numpy nd-array` containing reconstructed 'data' in shape [n_obs, n_vars].
         """
         if use_data:
-            latent = data
+            rec_data = self.sess.run(self.x_hat_inference, feed_dict={self.z_inference: data})
         else:
-            latent = self.to_latent(data)
-        rec_data = self.sess.run(self.x_hat, feed_dict={self.z_mean: latent, self.is_training: False})
+            rec_data = self.sess.run(self.x_hat_inference, feed_dict={self.x: data})
         return rec_data
 
     def linear_interpolation(self, source_adata, dest_adata, n_steps):
@@ -246,22 +387,18 @@ class VAEArith:
             ```
         """
         if sparse.issparse(source_adata.X):
-            source_average = source_adata.X.A.mean(axis=0).reshape((1, source_adata.shape[1]))
+            source_average = numpy.asarray(source_adata.X.mean(axis=0))
         else:
-            source_average = source_adata.X.A.mean(axis=0).reshape((1, source_adata.shape[1]))
+            source_average = source_adata.X.mean(axis=0, keepdims=True)
 
         if sparse.issparse(dest_adata.X):
-            dest_average = dest_adata.X.A.mean(axis=0).reshape((1, dest_adata.shape[1]))
+            dest_average = numpy.asarray(dest_adata.X.mean(axis=0))
         else:
-            dest_average = dest_adata.X.A.mean(axis=0).reshape((1, dest_adata.shape[1]))
+            dest_average = dest_adata.X.mean(axis=0, keepdims=True)
         start = self.to_latent(source_average)
         end = self.to_latent(dest_average)
-        vectors = numpy.zeros((n_steps, start.shape[1]))
-        alpha_values = numpy.linspace(0, 1, n_steps)
-        for i, alpha in enumerate(alpha_values):
-            vector = start * (1 - alpha) + end * alpha
-            vectors[i, :] = vector
-        vectors = numpy.array(vectors)
+        alpha_values = numpy.linspace(0, 1, n_steps).reshape(-1, 1)
+        vectors = (1 - alpha_values) * start + alpha_values * end
         interpolation = self.reconstruct(vectors, use_data=True)
         return interpolation
 
@@ -317,23 +454,53 @@ class VAEArith:
         else:
             ctrl_pred = adata_to_predict
         eq = min(ctrl_x.X.shape[0], stim_x.X.shape[0])
-        cd_ind = numpy.random.choice(range(ctrl_x.shape[0]), size=eq, replace=False)
-        stim_ind = numpy.random.choice(range(stim_x.shape[0]), size=eq, replace=False)
-        if sparse.issparse(ctrl_x.X) and sparse.issparse(stim_x.X):
-            latent_ctrl = self._avg_vector(ctrl_x.X.A[cd_ind, :])
-            latent_sim = self._avg_vector(stim_x.X.A[stim_ind, :])
-        else:
-            latent_ctrl = self._avg_vector(ctrl_x.X[cd_ind, :])
-            latent_sim = self._avg_vector(stim_x.X[stim_ind, :])
+        cd_ind = sample_without_replacement(ctrl_x.shape[0], eq)
+        stim_ind = sample_without_replacement(stim_x.shape[0], eq)
+        latent_ctrl = self._avg_vector(self._sample_dense(ctrl_x.X, cd_ind))
+        latent_sim = self._avg_vector(self._sample_dense(stim_x.X, stim_ind))
         delta = latent_sim - latent_ctrl
         if sparse.issparse(ctrl_pred.X):
-            latent_cd = self.to_latent(ctrl_pred.X.A)
+            ctrl_pred_x = ctrl_pred.X.A
         else:
-            latent_cd = self.to_latent(ctrl_pred.X)
-        stim_pred = delta + latent_cd
-        predicted_cells = self.reconstruct(stim_pred, use_data=True)
+            ctrl_pred_x = ctrl_pred.X
+        predicted_cells = self.sess.run(self.x_hat_inference, feed_dict={self.x: ctrl_pred_x, self.latent_shift: delta})
         return predicted_cells, delta
 
+    def export_decoder(self, path):
+        """
+            Exports the inference decoder with its folded weights as a frozen `GraphDef`
+            mapping the `latent` input in shape [n_obs, z_dim] to the `reconstruction`
+            output in shape [n_obs, n_vars]. The exported graph can be compiled ahead of
+            time with XLA's `tfcompile` (with a fixed batch size in its config) or served
+            without the VAEArith python object.
+
+            # Parameters
+                path: basestring
+                    path of the binary `.pb` file to write the frozen graph to.
+
+            # Returns
+                Nothing will be returned.
+
+            # Example
+            ```python
+                import anndata
+                import scgen
+                train_data = anndata.read("./data/train.h5ad")
+                network = scgen.VAEArith(x_dimension= train_data.shape[1], model_path="./models/test" )
+                network.restore_model()
+                network.export_decoder("./models/decoder.pb")
+            ```
+        """
+        graph_def = self.sess.graph.as_graph_def()
+        for node in graph_def.node:
+            if node.name == self.z_inference.op.name:
+                # Cut the encoder off: `latent` becomes a plain placeholder with the same dtype and shape.
+                node.op = "Placeholder"
+                del node.input[:]
+        frozen = tf.graph_util.convert_variables_to_constants(self.sess, graph_def, [self.x_hat_inference.op.name])
+        with tf.gfile.GFile(path, "wb") as f:
+            f.write(frozen.SerializeToString())
+
     def restore_model(self):
         """
             restores model weights from `model_to_use`.
@@ -355,8 +522,9 @@ class VAEArith:
             ```
         """
         self.saver.restore(self.sess, self.model_to_use)
+        self._fold_bn_for_inference()
 
-    def train(self, train_data, use_validation=False, valid_data=None, n_epochs=25, batch_size=32, early_stop_limit=20,
+    def train(self, train_data, use_validation=False, valid_data=None, n_epochs=25, batch_size=256, early_stop_limit=20,
               threshold=0.0025, initial_run=True, shuffle=True):
         """
             Trains the network `n_epochs` times with given `train_data`
@@ -375,6 +543,8 @@ class VAEArith:
                     Number of epochs to iterate and optimize network weights
                 batch_size: integer
                     size of each batch of training dataset to be fed to network while training.
+                    Larger batches keep the GPU busy and shorten training time considerably; smaller
+                    batches take more (noisier) optimization steps per epoch.
                 early_stop_limit: int
                     Number of consecutive epochs in which network loss is not going lower.
                     After this limit, the network will stop training.
@@ -404,10 +574,8 @@ class VAEArith:
         """
         if initial_run:
             log.info("----Training----")
-            assign_step_zero = tf.assign(self.global_step, 0)
-            _init_step = self.sess.run(assign_step_zero)
         if not initial_run:
-            self.saver.restore(self.sess, self.model_to_use)
+            self.restore_model()
         if use_validation and valid_data is None:
             raise Exception("valid_data is None but use_validation is True.")
         if shuffle:
@@ -416,32 +584,25 @@ class VAEArith:
         patience = early_stop_limit
         min_delta = threshold
         patience_cnt = 0
+        x_train = train_data.X.A if sparse.issparse(train_data.X) else train_data.X
+        x_train = numpy.ascontiguousarray(x_train, dtype=numpy.float32)
+        if use_validation:
+            x_valid = valid_data.X.A if sparse.issparse(valid_data.X) else valid_data.X
+            x_valid = numpy.ascontiguousarray(x_valid, dtype=numpy.float32)
         for it in range(n_epochs):
-            increment_global_step_op = tf.assign(self.global_step, self.global_step + 1)
-            _step = self.sess.run(increment_global_step_op)
-            current_step = self.sess.run(self.global_step)
             train_loss = 0
             for lower in range(0, train_data.shape[0], batch_size):
                 upper = min(lower + batch_size, train_data.shape[0])
-                if sparse.issparse(train_data.X):
-                    x_mb = train_data[lower:upper, :].X.A
-                else:
-                    x_mb = train_data[lower:upper, :].X
+                x_mb = x_train[lower:upper, :]
                 _, current_loss_train = self.sess.run([self.solver, self.vae_loss],
-                                                      feed_dict={self.x: x_mb, self.time_step: current_step,
-                                                                 self.size: len(x_mb), self.is_training: True})
+                                                      feed_dict={self.x: x_mb, self.is_training: True})
                 train_loss += current_loss_train
             if use_validation:
                 valid_loss = 0
                 for lower in range(0, valid_data.shape[0], batch_size):
                     upper = min(lower + batch_size, valid_data.shape[0])
-                    if sparse.issparse(valid_data.X):
-                        x_mb = valid_data[lower:upper, :].X.A
-                    else:
-                        x_mb = valid_data[lower:upper, :].X
-                    current_loss_valid = self.sess.run(self.vae_loss,
-                                                       feed_dict={self.x: x_mb, self.time_step: current_step,
-                                                                  self.size: len(x_mb), self.is_training: False})
+                    x_mb = x_valid[lower:upper, :]
+                    current_loss_valid = self.sess.run(self.vae_loss, feed_dict={self.x: x_mb})
                     valid_loss += current_loss_valid
                 loss_hist.append(valid_loss / valid_data.shape[0])
                 if it > 0 and loss_hist[it - 1] - loss_hist[it] > min_delta:
@@ -453,4 +614,5 @@ class VAEArith:
                     break
         else:
             save_path = self.saver.save(self.sess, self.model_to_use)
+        self._fold_bn_for_inference()
         log.info(f"Model saved in file: {save_path}. Training finished")
@@ -226,6 +226,37 @@ def shuffle_data(adata, labels=None):
         return anndata.AnnData(x)
 
 
+def sample_without_replacement(n, size):
+    """
+        Samples `size` distinct indices out of `range(n)`. Unlike `numpy.random.choice`
+        with `replace=False`, this does not permute all `n` indices, so it stays cheap
+        for large `n` and small `size`. The returned indices are not shuffled.
+
+        # Parameters
+        n: int
+            Number of indices to sample from.
+        size: int
+            Number of indices to be sampled.
+
+        # Returns
+            indices: numpy nd-array
+                Array of `size` distinct indices in `range(n)`.
+
+        # Example
+        ```python
+        import scgen
+        import anndata
+        train_data = anndata.read("./data/train.h5ad")
+        indices = sample_without_replacement(train_data.shape[0], 100)
+        ```
+    """
+    if size >= n:
+        return np.arange(n)
+    # Seeded from the global state so `np.random.seed` keeps results reproducible.
+    rng = np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+    return rng.choice(n, size=size, replace=False, shuffle=False)
+
+
 def batch_removal(network, adata):
     """
         Removes batch effect of adata
@@ -1,3 +1,4 @@
+import numpy as np
 import scgen
 import scanpy as sc
 
@@ -11,3 +12,15 @@ def test_batch_removal():
     network.sess.close()
 
 
+def test_sample_without_replacement():
+    indices = scgen.models.util.sample_without_replacement(1000, 50)
+    assert len(indices) == 50
+    assert len(np.unique(indices)) == 50
+    assert indices.min() >= 0 and indices.max() < 1000
+    np.testing.assert_array_equal(np.sort(scgen.models.util.sample_without_replacement(10, 10)), np.arange(10))
+    np.testing.assert_array_equal(np.sort(scgen.models.util.sample_without_replacement(10, 20)), np.arange(10))
+    np.random.seed(0)
+    first = scgen.models.util.sample_without_replacement(1000, 50)
+    np.random.seed(0)
+    second = scgen.models.util.sample_without_replacement(1000, 50)
+    np.testing.assert_array_equal(first, second)
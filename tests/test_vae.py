@@ -0,0 +1,44 @@
+import anndata
+import numpy as np
+import scgen
+import tensorflow as tf
+
+
+def _random_network(tmp_path, **kwargs):
+    np.random.seed(0)
+    train = anndata.AnnData(np.random.rand(64, 20).astype(np.float32))
+    network = scgen.VAEArith(x_dimension=train.shape[1], z_dimension=5, model_path=str(tmp_path / "scgen"), **kwargs)
+    network.train(train_data=train, n_epochs=1, batch_size=64, shuffle=False)
+    return network, train
+
+
+def test_folded_inference_matches_training_graph(tmp_path):
+    network, train = _random_network(tmp_path)
+    latent = network.to_latent(train.X)
+    expected_latent = network.sess.run(network.mu, feed_dict={network.x: train.X, network.is_training: False})
+    np.testing.assert_allclose(latent, expected_latent, rtol=1e-3, atol=1e-4)
+    reconstructed = network.reconstruct(latent, use_data=True)
+    expected_reconstructed = network.sess.run(network.x_hat, feed_dict={network.z_mean: latent,
+                                                                        network.is_training: False})
+    np.testing.assert_allclose(reconstructed, expected_reconstructed, rtol=1e-3, atol=1e-4)
+    network.sess.close()
+
+
+def test_export_decoder(tmp_path):
+    network, train = _random_network(tmp_path)
+    path = str(tmp_path / "decoder.pb")
+    network.export_decoder(path)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name="")
+    placeholders = [op.name for op in graph.get_operations() if op.type.startswith("Placeholder")]
+    assert placeholders == ["latent"]
+    assert not any("encoder/" in node.name for node in graph_def.node)
+    assert not any(node.op.startswith("Variable") for node in graph_def.node)
+    z = np.random.rand(10, 5).astype(np.float32)
+    with tf.Session(graph=graph) as sess:
+        reconstructed = sess.run("reconstruction:0", feed_dict={"latent:0": z})
+    np.testing.assert_allclose(reconstructed, network.reconstruct(z, use_data=True), rtol=1e-3, atol=1e-4)
+    network.sess.close()